@@ -73,6 +73,7 @@ setuptools.setup(
             "pep8-naming",
             "torchvision",
             "ipywidgets",
+            "scipy",
         ],
     },
 )
@@ -0,0 +1,368 @@
+import matplotlib.pyplot as plt
+import numpy as np
+import pytest
+import torch
+import torch.optim as optim
+
+from torch_lr_finder import LRFinder, PrefetchStep, Step
+from torch_lr_finder import lr_finder as mod_lr_finder
+from torch_lr_finder.lr_finder import ExponentialLR, LinearLR
+
+
+try:
+    import scipy  # noqa: F401
+
+    IS_SCIPY_AVAILABLE = True
+except ImportError:
+    IS_SCIPY_AVAILABLE = False
+
+
+class ScriptedStep(Step):
+    """A `Step` returning a predefined sequence of losses, optionally raising
+    `interrupt_at` instead of returning the loss of the given iteration."""
+
+    def __init__(self, losses, as_tensor=False, interrupt_at=None):
+        self.losses = losses
+        self.as_tensor = as_tensor
+        self.interrupt_at = interrupt_at
+        self.n_calls = 0
+        self.return_loss_calls = []
+        self.inference_mode_calls = []
+
+    def _step(self):
+        self.return_loss_calls.append(self.return_loss)
+        if hasattr(torch, "is_inference_mode_enabled"):
+            self.inference_mode_calls.append(torch.is_inference_mode_enabled())
+        if self.n_calls == self.interrupt_at:
+            raise KeyboardInterrupt
+        loss = self.losses[self.n_calls]
+        self.n_calls += 1
+        if self.as_tensor:
+            return torch.tensor(loss)
+        return loss
+
+    def _reset(self):
+        raise AssertionError("the scripted losses are exhausted")
+
+
+class ListPrefetchStep(PrefetchStep):
+    """A `PrefetchStep` iterating over a list of batches and recording the batches it
+    runs and how many times it was reset."""
+
+    def __init__(self, batches):
+        super(ListPrefetchStep, self).__init__("cpu")
+        self.batches = batches
+        self.batches_iter = iter(batches)
+        self.seen = []
+        self.n_resets = 0
+
+    def _next_batch(self):
+        return next(self.batches_iter)
+
+    def _step_batch(self, batch):
+        self.seen.append(batch.item())
+        return batch
+
+    def _reset(self):
+        self.n_resets += 1
+        self.batches_iter = iter(self.batches)
+
+
+def prepare_lr_finder(step, n_groups=1, val_step=None):
+    params = [torch.nn.Parameter(torch.zeros(1)) for _ in range(n_groups)]
+    optimizer = optim.SGD([{"params": [p]} for p in params], lr=1e-5)
+    return LRFinder(optimizer, "cpu", step, val_step)
+
+
+def reference_smooth(losses, smooth_f):
+    # The exponential smoothing as it used to be computed, one iteration at a time
+    smoothed = [losses[0]]
+    for loss in losses[1:]:
+        smoothed.append(smooth_f * loss + (1 - smooth_f) * smoothed[-1])
+    return smoothed
+
+
+class TestSmooth:
+    @pytest.mark.parametrize("use_scipy", [True, False])
+    @pytest.mark.parametrize("smooth_f", [0.05, 0.5, 0.9])
+    def test_smooth(self, monkeypatch, use_scipy, smooth_f):
+        if use_scipy and not IS_SCIPY_AVAILABLE:
+            pytest.skip("`scipy` is required to run this test.")
+        if not use_scipy:
+            monkeypatch.setattr(mod_lr_finder, "lfilter", None)
+
+        losses = np.random.rand(50)
+        smoothed = mod_lr_finder._smooth(losses, smooth_f)
+        assert smoothed == pytest.approx(reference_smooth(losses, smooth_f))
+
+    @pytest.mark.parametrize("use_scipy", [True, False])
+    def test_smooth_continued(self, monkeypatch, use_scipy):
+        if use_scipy and not IS_SCIPY_AVAILABLE:
+            pytest.skip("`scipy` is required to run this test.")
+        if not use_scipy:
+            monkeypatch.setattr(mod_lr_finder, "lfilter", None)
+
+        # Smoothing in windows, each one continuing from the last smoothed loss of
+        # the previous one, gives the same result as smoothing all losses at once
+        losses = np.random.rand(20)
+        first = mod_lr_finder._smooth(losses[:7], 0.3)
+        second = mod_lr_finder._smooth(losses[7:], 0.3, last_loss=first[-1])
+        assert np.concatenate([first, second]) == pytest.approx(
+            reference_smooth(losses, 0.3)
+        )
+
+    def test_smooth_disabled(self):
+        losses = np.random.rand(10)
+        assert np.array_equal(mod_lr_finder._smooth(losses, 0), losses)
+
+
+class TestLRSchedule:
+    @pytest.mark.parametrize("num_iter", [2, 5, 100])
+    def test_linear_schedule(self, num_iter):
+        start_lrs, end_lr = [1e-5, 1e-3], 1.0
+        schedule = mod_lr_finder._lr_schedule(start_lrs, end_lr, num_iter, "linear")
+
+        assert schedule.shape == (num_iter, len(start_lrs))
+        for i in range(num_iter):
+            r = i / (num_iter - 1)
+            expected = [lr + r * (end_lr - lr) for lr in start_lrs]
+            assert schedule[i] == pytest.approx(expected)
+
+    @pytest.mark.parametrize("num_iter", [2, 5, 100])
+    def test_exponential_schedule(self, num_iter):
+        start_lrs, end_lr = [1e-5, 1e-3], 1.0
+        schedule = mod_lr_finder._lr_schedule(start_lrs, end_lr, num_iter, "exp")
+
+        assert schedule.shape == (num_iter, len(start_lrs))
+        for i in range(num_iter):
+            r = i / (num_iter - 1)
+            expected = [lr * (end_lr / lr) ** r for lr in start_lrs]
+            assert schedule[i] == pytest.approx(expected)
+
+    @pytest.mark.parametrize(
+        "cls_scheduler, step_mode", [(LinearLR, "linear"), (ExponentialLR, "exp")]
+    )
+    def test_scheduler_matches_schedule(self, cls_scheduler, step_mode):
+        num_iter, end_lr = 10, 1.0
+        lr_finder = prepare_lr_finder(None, n_groups=2)
+        optimizer = lr_finder.optimizer
+        start_lrs = [group["lr"] for group in optimizer.param_groups]
+        scheduler = cls_scheduler(optimizer, end_lr, num_iter)
+
+        schedule = mod_lr_finder._lr_schedule(start_lrs, end_lr, num_iter, step_mode)
+        for i in range(num_iter):
+            lrs = [group["lr"] for group in optimizer.param_groups]
+            assert lrs == pytest.approx(schedule[i].tolist())
+            scheduler.step()
+
+    def test_scheduler_past_num_iter(self):
+        # Past `num_iter`, the schedulers keep following the same formula
+        num_iter, end_lr = 5, 1e-3
+        lr_finder = prepare_lr_finder(None)
+        optimizer = lr_finder.optimizer
+        scheduler = ExponentialLR(optimizer, end_lr, num_iter)
+
+        for _ in range(num_iter + 2):
+            scheduler.step()
+        r = (num_iter + 2) / (num_iter - 1)
+        assert optimizer.param_groups[0]["lr"] == pytest.approx(
+            1e-5 * (end_lr / 1e-5) ** r
+        )
+
+
+class TestDivergence:
+    @pytest.mark.parametrize("as_tensor", [False, True])
+    def test_diverge_mid_window(self, as_tensor):
+        losses = [1.0] * 10 + [6.0] + [1.0] * 9
+        step = ScriptedStep(losses, as_tensor=as_tensor)
+        lr_finder = prepare_lr_finder(step)
+        lr_finder.range_test(
+            end_lr=0.1, num_iter=20, smooth_f=0, diverge_th=5, diverge_check_steps=8
+        )
+
+        # The divergence is found at the end of the second window, the iterations
+        # that followed it are dropped from the history
+        assert step.n_calls == 16
+        assert len(lr_finder.history["lr"]) == 11
+        assert len(lr_finder.history["loss"]) == 11
+        assert lr_finder.history["loss"][-1] == pytest.approx(6.0)
+        assert lr_finder.best_loss == pytest.approx(1.0)
+
+    @pytest.mark.parametrize("as_tensor", [False, True])
+    def test_diverge_last_window(self, as_tensor):
+        # The last window is shorter than `diverge_check_steps`
+        losses = [2.0] * 5 + [1.0] * 14 + [6.0]
+        step = ScriptedStep(losses, as_tensor=as_tensor)
+        lr_finder = prepare_lr_finder(step)
+        lr_finder.range_test(
+            end_lr=0.1, num_iter=20, smooth_f=0, diverge_th=5, diverge_check_steps=8
+        )
+
+        assert step.n_calls == 20
+        assert len(lr_finder.history["lr"]) == 20
+        assert len(lr_finder.history["loss"]) == 20
+        assert lr_finder.best_loss == pytest.approx(1.0)
+
+    @pytest.mark.parametrize("diverge_check_steps", [1, 3, 8])
+    def test_windowed_smoothing(self, diverge_check_steps):
+        losses = (np.random.rand(20) + 1).tolist()
+        lr_finder = prepare_lr_finder(ScriptedStep(losses))
+        lr_finder.range_test(
+            end_lr=0.1,
+            num_iter=20,
+            smooth_f=0.05,
+            diverge_check_steps=diverge_check_steps,
+        )
+
+        expected = reference_smooth(losses, 0.05)
+        assert lr_finder.history["loss"] == pytest.approx(expected)
+        assert lr_finder.best_loss == pytest.approx(min(expected))
+
+    def test_interrupted(self):
+        # Losses not checked yet are still recorded and the history only holds the
+        # iterations that ran
+        step = ScriptedStep([1.0] * 20, interrupt_at=12)
+        lr_finder = prepare_lr_finder(step)
+        with pytest.raises(KeyboardInterrupt):
+            lr_finder.range_test(
+                end_lr=0.1, num_iter=20, smooth_f=0, diverge_check_steps=8
+            )
+
+        assert len(lr_finder.history["lr"]) == 12
+        assert lr_finder.history["loss"] == pytest.approx([1.0] * 12)
+
+    def test_invalid_losses(self):
+        # Mixing Tensor and float losses makes the first divergence check fail; the
+        # history must still only hold the recorded iterations
+        step = ScriptedStep([torch.tensor(1.0)] + [1.0] * 19)
+        lr_finder = prepare_lr_finder(step)
+        with pytest.raises(TypeError):
+            lr_finder.range_test(
+                end_lr=0.1, num_iter=20, smooth_f=0, diverge_check_steps=8
+            )
+
+        assert len(lr_finder.history["lr"]) == 0
+        assert len(lr_finder.history["loss"]) == 0
+
+
+class TestPrefetchStep:
+    def test_reset(self):
+        step = ListPrefetchStep([torch.tensor(float(i)) for i in range(3)])
+        losses = [step.step() for _ in range(7)]
+
+        # Batches keep their order across resets, and the source is reset once each
+        # time it is exhausted
+        assert step.seen == [0, 1, 2, 0, 1, 2, 0]
+        assert [loss.item() for loss in losses] == step.seen
+        assert step.n_resets == 2
+
+
+class TestSuggestLR:
+    def test_savgol_smooth(self):
+        if not IS_SCIPY_AVAILABLE:
+            pytest.skip("`scipy` is required to run this test.")
+        from scipy.signal import savgol_filter
+
+        values = np.random.rand(40)
+        smoothed = mod_lr_finder._savgol_smooth(values, 11, polyorder=3)
+        assert smoothed == pytest.approx(savgol_filter(values, 11, polyorder=3))
+
+    def test_suggest_lr_noisy(self):
+        # The steepest descent of the loss is at lr=1e-3, and a one-point dip at
+        # index 70 would be picked by unsmoothed differences
+        lrs = np.geomspace(1e-5, 1, 100)
+        losses = 2 - np.tanh(2 * (np.log10(lrs) + 3))
+        losses[70] -= 0.5
+        lr_finder = prepare_lr_finder(None)
+        lr_finder.history = {"lr": lrs, "loss": losses}
+
+        raw_slopes = np.diff(losses) / np.diff(np.log(lrs))
+        assert np.argmin(raw_slopes) == 69
+
+        fig, ax = plt.subplots()
+        ax, lr = lr_finder.plot(skip_start=0, skip_end=0, suggest_lr=True, ax=ax)
+        assert 10 ** -3.5 < lr < 10 ** -2.5
+
+    def test_suggest_lr_first_point(self):
+        lrs = np.geomspace(1e-5, 1e-1, 5)
+        lr_finder = prepare_lr_finder(None)
+        lr_finder.history = {"lr": lrs, "loss": np.array([10, 1, 0.9, 0.8, 0.7])}
+
+        fig, ax = plt.subplots()
+        results = lr_finder.plot(skip_start=0, skip_end=0, suggest_lr=True, ax=ax)
+        assert results[1] == pytest.approx(1e-5)
+
+
+class TestValStep:
+    def test_train_loss_not_requested(self):
+        train_step = ScriptedStep([1.0] * 10)
+        val_step = ScriptedStep([1.0] * 10)
+        lr_finder = prepare_lr_finder(train_step, val_step=val_step)
+        lr_finder.range_test(end_lr=0.1, num_iter=10)
+
+        # Only the validation loss is used, the train step is told so
+        assert train_step.return_loss_calls == [False] * 10
+        assert val_step.return_loss_calls == [True] * 10
+
+    def test_train_loss_requested_without_val_step(self):
+        train_step = ScriptedStep([1.0] * 10)
+        lr_finder = prepare_lr_finder(train_step)
+        lr_finder.range_test(end_lr=0.1, num_iter=10)
+
+        assert train_step.return_loss_calls == [True] * 10
+
+    @pytest.mark.skipif(
+        not hasattr(torch, "is_inference_mode_enabled"),
+        reason="`torch.inference_mode` requires PyTorch 1.9 or later.",
+    )
+    def test_val_step_inference_mode(self):
+        train_step = ScriptedStep([1.0] * 10)
+        val_step = ScriptedStep([1.0] * 10)
+        lr_finder = prepare_lr_finder(train_step, val_step=val_step)
+        lr_finder.range_test(end_lr=0.1, num_iter=10)
+
+        assert val_step.inference_mode_calls == [True] * 10
+        assert train_step.inference_mode_calls == [False] * 10
+
+
+class TestState:
+    def make_step(self, model, optimizer):
+        optimizer.zero_grad()
+        model(torch.randn(4, 3)).sum().backward()
+        optimizer.step()
+
+    def test_restore_state(self):
+        torch.manual_seed(0)
+        model = torch.nn.Linear(3, 2)
+        optimizer = torch.optim.SGD(model.parameters(), lr=1e-3, momentum=0.9)
+        lr_finder = LRFinder(optimizer, "cpu", None)
+
+        self.make_step(model, optimizer)
+        state = lr_finder.save_state(model)
+        weight = model.weight.detach().clone()
+        momentum = optimizer.state[model.weight]["momentum_buffer"]
+        saved_momentum = momentum.clone()
+
+        for _ in range(2):
+            # Change the weights, the optimizer state and the learning rate
+            for _ in range(3):
+                self.make_step(model, optimizer)
+            optimizer.param_groups[0]["lr"] = 0.5
+            assert not torch.equal(model.weight, weight)
+            assert not torch.equal(momentum, saved_momentum)
+
+            # The snapshot can be restored more than once, in place
+            lr_finder.restore_state(state, model)
+            assert torch.equal(model.weight, weight)
+            assert optimizer.param_groups[0]["lr"] == 1e-3
+            assert optimizer.state[model.weight]["momentum_buffer"] is momentum
+            assert torch.equal(momentum, saved_momentum)
+
+    def test_restore_state_without_model(self):
+        model = torch.nn.Linear(3, 2)
+        optimizer = torch.optim.SGD(model.parameters(), lr=1e-3)
+        lr_finder = LRFinder(optimizer, "cpu", None)
+        state = lr_finder.save_state()
+
+        with pytest.raises(ValueError, match="state of a model"):
+            lr_finder.restore_state(state, model)
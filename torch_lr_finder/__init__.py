@@ -1,3 +1,4 @@
 from torch_lr_finder.lr_finder import LRFinder
-from torch_lr_finder.lr_finder import TrainDataLoaderIter
-from torch_lr_finder.lr_finder import ValDataLoaderIter
+from torch_lr_finder.lr_finder import Step
+from torch_lr_finder.lr_finder import PrefetchStep
+from torch_lr_finder.lr_finder import CUDAGraphStep
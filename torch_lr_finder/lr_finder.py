@@ -1,32 +1,151 @@
-import copy
+import inspect
 import os
+import warnings
 import torch
 import numpy as np
-from tqdm.autonotebook import tqdm
+from tqdm.auto import tqdm
 from torch.optim.lr_scheduler import _LRScheduler
 import matplotlib.pyplot as plt
 from torch.utils.data import DataLoader
 
 from packaging import version
 
+try:
+    from scipy.signal import lfilter
+except ImportError:
+    lfilter = None
+
 PYTORCH_VERSION = version.parse(torch.__version__)
 
+# `torch.inference_mode` was added in PyTorch 1.9
+_inference_mode = getattr(torch, "inference_mode", torch.no_grad)
+
+try:
+    from torch.utils._pytree import tree_map as _pytree_map
+
+    # `is_leaf` was added to `tree_map` after `torch.utils._pytree` itself
+    _PYTREE_HAS_IS_LEAF = "is_leaf" in inspect.signature(_pytree_map).parameters
+except ImportError:
+    _pytree_map = None
+    _PYTREE_HAS_IS_LEAF = False
+
+
+def _tree_map(fn, obj, is_leaf=None):
+    """Applies `fn` to the leaves of a (nested) tuple, list or dict.
+
+    Arguments:
+        fn (callable): the function applied to each leaf.
+        obj: the object to map over.
+        is_leaf (callable, optional): if given, the objects for which it returns
+            True are passed to `fn` as a whole, even if they are containers.
+            Default: None.
+
+    Returns:
+        An object with the same structure as `obj`.
+    """
+    if _pytree_map is not None and (is_leaf is None or _PYTREE_HAS_IS_LEAF):
+        if is_leaf is None:
+            return _pytree_map(fn, obj)
+        return _pytree_map(fn, obj, is_leaf=is_leaf)
+
+    # Fallback for PyTorch versions that don't ship `torch.utils._pytree` or whose
+    # `tree_map` doesn't support `is_leaf`
+    if is_leaf is not None and is_leaf(obj):
+        return fn(obj)
+    elif isinstance(obj, tuple):
+        return tuple(_tree_map(fn, o, is_leaf) for o in obj)
+    elif isinstance(obj, list):
+        return [_tree_map(fn, o, is_leaf) for o in obj]
+    elif isinstance(obj, dict):
+        return {k: _tree_map(fn, o, is_leaf) for k, o in obj.items()}
+    else:
+        return fn(obj)
+
+
+_warned_unpinned = False
+
+
+def _warn_unpinned():
+    global _warned_unpinned
+    if not _warned_unpinned:
+        _warned_unpinned = True
+        warnings.warn(
+            "Moving a Tensor that is not in pinned memory to a CUDA device: the copy "
+            "is synchronous even with `non_blocking=True`. Create the DataLoader with "
+            "`pin_memory=True` or use `Step.pin_batch()`."
+        )
+
 
 class Step:
+    """One iteration of the user's training (or evaluation) loop.
+
+    Subclasses implement `_step()`, which fetches a batch, runs the model on it and
+    returns the loss, and `_reset()`, which restarts the batch iterator once it is
+    exhausted.
+
+    Batches can be moved to the device with `_move_to_device()`. The copy is only
+    asynchronous (and can thus overlap with computation) when the source Tensors are
+    in pinned memory, so create the DataLoader with `pin_memory=True`; if that is not
+    possible, `pin_batch()` pins a batch explicitly. A warning is issued the first
+    time an unpinned Tensor is copied to a CUDA device. See also:
+    https://github.com/davidtvs/pytorch-lr-finder/pull/31
+
+    `return_loss` is False when the caller discards the loss (e.g. `LRFinder` only
+    uses the loss of `val_step` when one is given); `_step()` can then skip computing
+    or converting it and return None.
+    """
+
+    return_loss = True
+
+    def pin_batch(self, batch):
+        """Copies the CPU Tensors found in `batch` to pinned memory.
+
+        Arguments:
+            batch: a Tensor, or a (nested) tuple, list or dict of Tensors.
+
+        Returns:
+            `batch` with the same structure, with its CPU Tensors pinned.
+        """
+
+        def pin(obj):
+            if isinstance(obj, torch.Tensor) and obj.device.type == "cpu":
+                return obj.pin_memory()
+            return obj
+
+        return _tree_map(pin, batch)
 
     def _move_to_device(self, *things, device, non_blocking=True):
-        def move(obj, device, non_blocking=True):
+        """Moves each of `things` (Tensors, or nested tuples, lists and dicts of
+        them) to `device`.
+
+        Returns:
+            A tuple with the moved `things`, in order. It is deliberately not a
+            generator: all the copies are issued before this method returns, so that
+            with `non_blocking=True` they run while the caller keeps working instead
+            of being delayed until the result is iterated.
+        """
+        # `is_pinned()` is not free, so stop checking once the warning was issued
+        check_pinned = (
+            not _warned_unpinned
+            and non_blocking
+            and torch.device(device).type == "cuda"
+        )
+
+        def move(obj):
+            if (
+                check_pinned
+                and isinstance(obj, torch.Tensor)
+                and obj.device.type == "cpu"
+                and not obj.is_pinned()
+            ):
+                _warn_unpinned()
             if hasattr(obj, "to"):
                 return obj.to(device, non_blocking=non_blocking)
-            elif isinstance(obj, tuple):
-                return tuple(move(o, device, non_blocking) for o in obj)
-            elif isinstance(obj, list):
-                return [move(o, device, non_blocking) for o in obj]
-            elif isinstance(obj, dict):
-                return {k: move(o, device, non_blocking) for k, o in obj.items()}
-            else:
-                return obj
-        return (move(i,device=device,non_blocking=non_blocking) for i in things)
+            return obj
+
+        # Objects with a `.to()` method are moved as a whole, even when they are
+        # containers themselves (e.g. `PackedSequence`, a named tuple)
+        return _tree_map(move, things, is_leaf=lambda obj: hasattr(obj, "to"))
 
     def _step(self):
         """
@@ -41,7 +160,8 @@ class Step:
         """
         raise NotImplementedError('_reset() is not implemented')
 
-    def step(self):
+    def step(self, return_loss=True):
+        self.return_loss = return_loss
         try:
             return self._step()
         except StopIteration:
@@ -49,6 +169,193 @@ class Step:
             return self._step()
 
 
+class PrefetchStep(Step):
+    """A `Step` that copies the next batch to the device while the current one is
+    being processed.
+
+    On CUDA devices the copy is issued on a dedicated stream, as done by the
+    `data_prefetcher` of NVIDIA Apex's ImageNet example, so that it overlaps with the
+    forward and backward passes of the current batch. As for `Step`, the batches must
+    be in pinned memory for the copy to be asynchronous.
+
+    Subclasses implement `_next_batch()`, `_step_batch()` and `_reset()` instead of
+    `_step()`.
+
+    Arguments:
+        device (str or torch.device): the device the batches are moved to.
+
+    Reference:
+    NVIDIA/apex: https://github.com/NVIDIA/apex/blob/master/examples/imagenet/main_amp.py
+    """
+
+    def __init__(self, device):
+        self.device = torch.device(device)
+        self.stream = None
+        if self.device.type == "cuda":
+            self.stream = torch.cuda.Stream(self.device)
+        self.next_batch = None
+        self._preloaded = False
+
+    def _next_batch(self):
+        """
+        fetch the next batch from your data source, still on the host
+        raise StopIteration when the data source is exhausted
+        :return:
+        """
+        raise NotImplementedError('_next_batch() is not implemented')
+
+    def _step_batch(self, batch):
+        """
+        run your model on one batch that is already on the device
+        :return:
+        """
+        raise NotImplementedError('_step_batch() is not implemented')
+
+    def _preload(self):
+        try:
+            batch = self._next_batch()
+        except StopIteration:
+            self.next_batch = None
+            return
+
+        if self.stream is None:
+            (self.next_batch,) = self._move_to_device(batch, device=self.device)
+            return
+        with torch.cuda.stream(self.stream):
+            (self.next_batch,) = self._move_to_device(
+                batch, device=self.device, non_blocking=True
+            )
+
+    def _device_batch(self):
+        """Returns the preloaded batch once its copy is done and starts preloading the
+        following one.
+
+        Raises StopIteration when the data source is exhausted.
+        """
+        if not self._preloaded:
+            self._preload()
+            self._preloaded = True
+
+        if self.stream is not None:
+            current_stream = torch.cuda.current_stream(self.device)
+            current_stream.wait_stream(self.stream)
+        batch = self.next_batch
+        if batch is None:
+            # The data source is exhausted: `step()` resets it and calls us again
+            self._preloaded = False
+            raise StopIteration
+
+        if self.stream is not None:
+            # The batch was allocated on the side stream; tell the caching allocator
+            # it is used on the current one so its memory isn't reused too early
+            for tensor in _tensors(batch):
+                tensor.record_stream(current_stream)
+
+        # Start copying the following batch before running the model on this one
+        self._preload()
+        return batch
+
+    def _step(self):
+        return self._step_batch(self._device_batch())
+
+
+class CUDAGraphStep(PrefetchStep):
+    """A `PrefetchStep` that captures `_step_batch()` in a CUDA graph and replays it
+    on every following iteration.
+
+    For small models most of the time of an iteration is spent launching kernels;
+    replaying a graph launches all of them at once. The first `warmup_iters`
+    iterations run eagerly (on a side stream, as CUDA graphs require), the next one
+    is captured, and from then on each batch is copied into the captured input
+    Tensors before the graph is replayed. This imposes a few constraints:
+        - batches must all have the same structure and shapes (e.g. create the
+          DataLoader with `drop_last=True`);
+        - `_step_batch()` must run entirely on the device: no `.item()`, no
+          host-side control flow depending on Tensor values;
+        - the optimizer must be created with a Tensor learning rate on the device
+          (and `capturable=True` for the optimizers that support it), so that the
+          learning rate changes made by `LRFinder` are seen by the replayed graph.
+
+    Arguments:
+        device (str or torch.device): the CUDA device the batches are moved to.
+        warmup_iters (int, optional): the number of iterations run eagerly before
+            capturing the graph. Default: 3.
+
+    Reference:
+    CUDA Graphs: https://pytorch.org/docs/stable/notes/cuda.html#cuda-graphs
+    """
+
+    def __init__(self, device, warmup_iters=3):
+        super(CUDAGraphStep, self).__init__(device)
+        if self.device.type != "cuda":
+            raise ValueError("CUDAGraphStep requires a CUDA device")
+        if not hasattr(torch.cuda, "graph"):
+            raise RuntimeError("CUDAGraphStep requires PyTorch 1.10 or later")
+
+        self.warmup_iters = warmup_iters
+        self.graph = None
+        self._n_warmup = 0
+        self._warmup_stream = torch.cuda.Stream(self.device)
+        self._static_tensors = None
+        self._static_loss = None
+
+    def _step(self):
+        batch = self._device_batch()
+
+        if self.graph is not None:
+            tensors = _tensors(batch)
+            if len(tensors) != len(self._static_tensors) or any(
+                tensor.shape != static_tensor.shape
+                for tensor, static_tensor in zip(tensors, self._static_tensors)
+            ):
+                raise ValueError(
+                    "batch doesn't match the inputs of the captured CUDA graph; all "
+                    "batches must have the same structure and shapes (e.g. create "
+                    "the DataLoader with `drop_last=True`)"
+                )
+            for static_tensor, tensor in zip(self._static_tensors, tensors):
+                static_tensor.copy_(tensor, non_blocking=True)
+            self.graph.replay()
+            return self._output_loss()
+
+        current_stream = torch.cuda.current_stream(self.device)
+        if self._n_warmup < self.warmup_iters:
+            self._n_warmup += 1
+            self._warmup_stream.wait_stream(current_stream)
+            with torch.cuda.stream(self._warmup_stream):
+                loss = self._step_batch(batch)
+            current_stream.wait_stream(self._warmup_stream)
+            return loss
+
+        # Capture the step on this batch; its Tensors become the inputs of the graph.
+        # Capturing doesn't run the work, so the graph is replayed once right away
+        self._static_tensors = _tensors(batch)
+        self.graph = torch.cuda.CUDAGraph()
+        with torch.cuda.graph(self.graph):
+            self._static_loss = self._step_batch(batch)
+        self.graph.replay()
+        return self._output_loss()
+
+    def _output_loss(self):
+        # The output of the graph is overwritten by the next replay
+        if self._static_loss is None:
+            return None
+        return self._static_loss.detach().clone()
+
+
+def _tensors(obj):
+    # Lists the Tensors found in a (nested) tuple, list or dict, in a fixed order
+    tensors = []
+
+    def collect(o):
+        if isinstance(o, torch.Tensor):
+            tensors.append(o)
+        return o
+
+    _tree_map(collect, obj)
+    return tensors
+
+
 class LRFinder(object):
     """Learning rate range test.
 
@@ -64,8 +371,32 @@ class LRFinder(object):
             optional ordinal for the device type (e.g. "cuda:X", where is the ordinal).
             Alternatively, can be an object representing the device on which the
             computation will take place.
+            For asynchronous host to device copies, the DataLoaders used by the
+            steps should be created with `pin_memory=True` (see `Step`).
         train_step (Step): User's Implemtation of Step. It will be called as `loss = train_step.step()`.
+            `loss` can be a Python float or a 0-dim Tensor; returning the Tensor
+            without calling `.item()` on it avoids a host-device sync per iteration.
         val_step (Step): User's Implemtation of Step. It will be called as `loss = val_step.step()`. default: None
+            When given, `train_step` is called as `train_step.step(return_loss=False)`.
+            `val_step.step()` is run under `torch.inference_mode()` (or
+            `torch.no_grad()` on PyTorch < 1.9).
+        compile_step (bool, optional): if True, the model code of `train_step` (its
+            `_step()`, or `_step_batch()` for a `PrefetchStep`) is wrapped with
+            `torch.compile(mode="reduce-overhead")`, which cuts the CPU launch overhead
+            that dominates the range test of small models. Requires PyTorch 2.0 or
+            later and static input shapes; the first iterations are slow while the
+            step is compiled, which is why `plot()` skips them by default. Can't be
+            used with a `CUDAGraphStep`. Note that the compiled method replaces the
+            original one on the `train_step` instance for good, and that the learning
+            rates of `optimizer` are converted to Tensors (see below), as a compiled
+            optimizer step would be recompiled for every new float learning rate.
+            Default: False.
+
+    Note: the learning rates of the optimizer are set as Python floats during the
+    range test. Do not use Tensor learning rates, as reading them back forces a
+    synchronization between the host and the device on every iteration. The only
+    exceptions are `CUDAGraphStep` and `compile_step=True`, which require Tensor
+    learning rates on the device; these are updated in place instead.
 
     Example:
         >>> lr_finder = LRFinder(optimizer, device="cuda", train_step)
@@ -83,16 +414,42 @@ class LRFinder(object):
         device,
         train_step:Step,
         val_step:Step = None,
+        compile_step=False,
     ):
 
         self.train_step = train_step
         self.val_step = val_step
 
+        if compile_step:
+            if not hasattr(torch, "compile"):
+                raise RuntimeError("compile_step requires PyTorch 2.0 or later")
+            if isinstance(train_step, CUDAGraphStep):
+                raise ValueError(
+                    "compile_step can't be used with a CUDAGraphStep, which already "
+                    "captures its step in a CUDA graph"
+                )
+            # Only compile the model code, the CUDA stream handling of `PrefetchStep`
+            # must stay outside of the compiled graph. The step may be shared by
+            # several finders, in which case it is already compiled
+            name = "_step_batch" if isinstance(train_step, PrefetchStep) else "_step"
+            step_fn = getattr(train_step, name)
+            if not getattr(step_fn, "_compiled_by_lr_finder", False):
+                setattr(train_step, name, _compile_step(step_fn))
+
+            # Dynamo specializes on float learning rates, so each new one would
+            # recompile the optimizer step; Tensor learning rates are updated in place
+            for param_group in optimizer.param_groups:
+                if not isinstance(param_group["lr"], torch.Tensor):
+                    param_group["lr"] = torch.tensor(
+                        float(param_group["lr"]),
+                        device=param_group["params"][0].device,
+                    )
+
         # Check if the optimizer is already attached to a scheduler
         self.optimizer = optimizer
         self._check_for_scheduler()
 
-        self.history = {"lr": [], "loss": []}
+        self.history = {"lr": np.empty(0), "loss": np.empty(0)}
         self.best_loss = None
         self.device = device
 
@@ -106,6 +463,7 @@ class LRFinder(object):
         diverge_th=5,
         accumulation_steps=1,
         non_blocking_transfer=True,
+        diverge_check_steps=8,
     ):
         """Performs the learning rate range test.
 
@@ -128,8 +486,10 @@ class LRFinder(object):
                 you should inherit from `ValDataLoaderIter` class and
                 redefine method `inputs_labels_from_batch` so that
                 it outputs (inputs, labels). Default: None.
-            start_lr (float, optional): the starting learning rate for the range test.
-                Default: None (uses the learning rate from the optimizer).
+            start_lr (float or list, optional): the starting learning rate for the
+                range test, either a single value or one per parameter group. Must
+                not be a Tensor. Default: None (uses the learning rate from the
+                optimizer).
             end_lr (float, optional): the maximum learning rate to test. Default: 10.
             num_iter (int, optional): the number of iterations over which the test
                 occurs. Default: 100.
@@ -145,6 +505,12 @@ class LRFinder(object):
             non_blocking_transfer (bool, optional): when non_blocking_transfer is set,
                 tries to convert/move data to the device asynchronously if possible,
                 e.g., moving CPU Tensors with pinned memory to CUDA devices. Default: True.
+            diverge_check_steps (int, optional): the number of iterations between two
+                divergence checks. Each check waits for the device to catch up, so
+                checking less often is faster; the history is still trimmed at the
+                exact iteration where the loss diverged, but up to
+                `diverge_check_steps - 1` extra iterations may have been run.
+                Default: 8.
 
         Example (fastai approach):
             >>> lr_finder = LRFinder(net, optimizer, criterion, device="cuda")
@@ -172,6 +538,9 @@ class LRFinder(object):
             >>> finder = torch_lr_finder.LRFinder(model, optimizer, partial(model._train_loss, need_one_hot=False))
             >>> finder.range_test(train_data_iter, end_lr=10, num_iter=300, diverge_th=10)
 
+        The learning rate and (smoothed) loss of each iteration are stored as
+        `numpy.ndarray` in `self.history["lr"]` and `self.history["loss"]`.
+
         Reference:
         [Training Neural Nets on Larger Batches: Practical Tips for 1-GPU, Multi-GPU & Distributed setups](
         https://medium.com/huggingface/ec88c3e51255)
@@ -179,7 +548,7 @@ class LRFinder(object):
         """
 
         # Reset test results
-        self.history = {"lr": [], "loss": []}
+        self.history = {"lr": np.empty(0), "loss": np.empty(0)}
         self.best_loss = None
 
         # Check if the optimizer is already attached to a scheduler
@@ -189,43 +558,133 @@ class LRFinder(object):
         if start_lr:
             self._set_learning_rate(start_lr)
 
-        # Initialize the proper learning rate policy
-        if step_mode.lower() == "exp":
-            lr_schedule = ExponentialLR(self.optimizer, end_lr, num_iter)
-        elif step_mode.lower() == "linear":
-            lr_schedule = LinearLR(self.optimizer, end_lr, num_iter)
-        else:
+        # Precompute the learning rate of every parameter group for each iteration
+        if step_mode.lower() not in ("exp", "linear"):
             raise ValueError("expected one of (exp, linear), got {}".format(step_mode))
+        start_lrs = [
+            float(param_group["lr"]) for param_group in self.optimizer.param_groups
+        ]
+        lr_schedule = _lr_schedule(start_lrs, end_lr, num_iter, step_mode.lower())
 
         if smooth_f < 0 or smooth_f >= 1:
             raise ValueError("smooth_f is outside the range [0, 1[")
+        if diverge_check_steps < 1:
+            raise ValueError("diverge_check_steps must be a positive integer")
+
+        # The history is preallocated and trimmed to the recorded iterations once the
+        # test stops
+        self.history["lr"] = lr_schedule[:, 0].copy()
+        self.history["loss"] = np.empty(num_iter)
+
+        # Convert the schedule to Python floats and find out how the learning rates are
+        # stored once, so that updating them in the loop is a plain assignment
+        lr_rows = lr_schedule.tolist()
+        param_groups = list(self.optimizer.param_groups)
+        tensor_lrs = any(
+            isinstance(param_group["lr"], torch.Tensor) for param_group in param_groups
+        )
+
+        # Raw losses are kept on the device they were computed on and only copied to
+        # the host, smoothed and checked for divergence once every few iterations
+        raw_losses = []
+        n_checked = 0
+        diverged = False
+
+        # Bind what the loop uses to local names to save attribute lookups
+        train_step = self.train_step.step
+        val_step = self.val_step.step if self.val_step is not None else None
+        append_loss = raw_losses.append
+
+        # Refresh the progress bar at most ~100 times to keep it out of the hot loop
+        progress = tqdm(
+            range(num_iter), miniters=max(1, num_iter // 100), mininterval=0.5
+        )
+        try:
+            for iteration in progress:
+                # Update the learning rate
+                if tensor_lrs:
+                    self._set_learning_rate(lr_rows[iteration])
+                else:
+                    for param_group, lr in zip(param_groups, lr_rows[iteration]):
+                        param_group["lr"] = lr
+
+                # Train on batch and retrieve loss; the training loss is not needed
+                # when the validation loss is used
+                if val_step is None:
+                    loss = train_step()
+                else:
+                    train_step(return_loss=False)
+                    with _inference_mode():
+                        loss = val_step()
+
+                if isinstance(loss, torch.Tensor):
+                    loss = loss.detach()
+                append_loss(loss)
+
+                if (
+                    (iteration + 1) % diverge_check_steps != 0
+                    and iteration + 1 != num_iter
+                ):
+                    continue
+
+                # Check if the loss has diverged over the last iterations; if it has,
+                # stop the test
+                n_checked, diverged = self._record_losses(
+                    raw_losses, n_checked, smooth_f, diverge_th
+                )
+                del raw_losses[:]
+                if diverged:
+                    progress.close()
+                    print("Stopping early, the loss has diverged")
+                    break
+        finally:
+            # The test may also stop because of an exception (e.g. KeyboardInterrupt):
+            # record the losses that weren't checked yet and drop the iterations that
+            # didn't run or followed the divergence
+            if raw_losses and not diverged:
+                # Losses are only left unchecked when an exception is being raised;
+                # if recording them fails too (e.g. the losses themselves are what
+                # made the loop fail), let the original exception through
+                try:
+                    n_checked, _ = self._record_losses(
+                        raw_losses, n_checked, smooth_f, diverge_th
+                    )
+                except Exception:
+                    pass
+            self.history["lr"] = self.history["lr"][:n_checked]
+            self.history["loss"] = self.history["loss"][:n_checked]
+            progress.close()
 
-        for iteration in tqdm(range(num_iter)):
-            # Train on batch and retrieve loss
-            loss = self.train_step.step()
-            if self.val_step is not None:
-                loss = self.val_step.step()
-
-            # Update the learning rate
-            self.history["lr"].append(lr_schedule.get_lr()[0])
-            lr_schedule.step()
+        print("Learning rate search finished. See the graph with {finder_name}.plot()")
 
-            # Track the best loss and smooth it if smooth_f is specified
-            if iteration == 0:
-                self.best_loss = loss
-            else:
-                if smooth_f > 0:
-                    loss = smooth_f * loss + (1 - smooth_f) * self.history["loss"][-1]
-                if loss < self.best_loss:
-                    self.best_loss = loss
+    def _record_losses(self, raw_losses, n_checked, smooth_f, diverge_th):
+        """Smooths the raw losses of the last iterations, stores them in the history
+        and checks them for divergence.
 
-            # Check if the loss has diverged; if it has, stop the test
-            self.history["loss"].append(loss)
-            if loss > diverge_th * self.best_loss:
-                print("Stopping early, the loss has diverged")
-                break
+        Arguments:
+            raw_losses (list): the raw losses (floats or Tensors) of the iterations
+                that follow the `n_checked` ones already in the history.
+            n_checked (int): the number of iterations already in the history.
+            smooth_f (float): the loss smoothing factor.
+            diverge_th (int): the divergence threshold.
 
-        print("Learning rate search finished. See the graph with {finder_name}.plot()")
+        Returns:
+            The number of iterations in the history and whether the loss has diverged.
+            If it has, the iterations that followed the divergence are not recorded.
+        """
+        history_loss = self.history["loss"]
+        last_loss = history_loss[n_checked - 1] if n_checked else None
+        losses = _smooth(_losses_to_numpy(raw_losses), smooth_f, last_loss)
+        best_losses = np.minimum.accumulate(losses)
+        if self.best_loss is not None:
+            best_losses = np.minimum(best_losses, self.best_loss)
+
+        diverged_idx = np.flatnonzero(losses > diverge_th * best_losses)
+        diverged = len(diverged_idx) > 0
+        n_new = int(diverged_idx[0]) + 1 if diverged else len(losses)
+        history_loss[n_checked : n_checked + n_new] = losses[:n_new]
+        self.best_loss = float(best_losses[n_new - 1])
+        return n_checked + n_new, diverged
 
     def _set_learning_rate(self, new_lrs):
         if not isinstance(new_lrs, list):
@@ -236,8 +695,87 @@ class LRFinder(object):
                 + "in the given optimizer"
             )
 
+        # Store plain Python floats: with a Tensor learning rate, recent PyTorch
+        # versions call `.item()` on it, which synchronizes the host with the device.
+        # Tensor learning rates (needed by `CUDAGraphStep`) are updated in place so
+        # that captured graphs keep pointing at them
         for param_group, new_lr in zip(self.optimizer.param_groups, new_lrs):
-            param_group["lr"] = new_lr
+            if isinstance(param_group["lr"], torch.Tensor):
+                param_group["lr"].fill_(float(new_lr))
+            else:
+                param_group["lr"] = float(new_lr)
+
+    def save_state(self, model=None):
+        """Takes a snapshot of the optimizer state and, optionally, of the model.
+
+        Tensors are cloned instead of going through `copy.deepcopy`, which is much
+        slower on large states.
+
+        Arguments:
+            model (torch.nn.Module, optional): the model trained by the steps. If
+                given, its state is saved as well. Default: None.
+
+        Returns:
+            A dict to pass to `restore_state()`.
+
+        Example:
+            >>> state = lr_finder.save_state(model)
+            >>> lr_finder.range_test(end_lr=100, num_iter=100)
+            >>> lr_finder.restore_state(state, model)
+        """
+        state = {"optimizer": _clone_tensors(self.optimizer.state_dict())}
+        if model is not None:
+            model_state = model.state_dict()
+            # Replace the values in place to keep the state dict metadata; values
+            # other than Tensors (e.g. from `get_extra_state()`) are kept as is
+            for key, value in model_state.items():
+                model_state[key] = _clone_tensors(value)
+            state["model"] = model_state
+        return state
+
+    def restore_state(self, state, model=None):
+        """Restores the optimizer and, optionally, the model to a snapshot taken with
+        `save_state()`.
+
+        The state is copied into the existing Tensors of the optimizer and the model
+        rather than replacing them, so that anything referencing them, like the graph
+        captured by a `CUDAGraphStep`, keeps working with the restored values.
+
+        Arguments:
+            state (dict): the snapshot returned by `save_state()`.
+            model (torch.nn.Module, optional): the model to restore. Its state must
+                have been saved by passing it to `save_state()`. Default: None.
+        """
+        if model is not None and "model" not in state:
+            raise ValueError("`state` does not hold the state of a model")
+
+        optimizer_state = state["optimizer"]
+        param_groups = self.optimizer.param_groups
+        if len(optimizer_state["param_groups"]) != len(param_groups) or any(
+            len(saved_group["params"]) != len(param_group["params"])
+            for saved_group, param_group in zip(
+                optimizer_state["param_groups"], param_groups
+            )
+        ):
+            raise ValueError("`state` does not match the parameters of the optimizer")
+
+        for saved_group, param_group in zip(
+            optimizer_state["param_groups"], param_groups
+        ):
+            _copy_into(param_group, saved_group, keep=("params",))
+
+        params = [
+            param for param_group in param_groups for param in param_group["params"]
+        ]
+        for i, param in enumerate(params):
+            if i in optimizer_state["state"]:
+                _copy_into(self.optimizer.state[param], optimizer_state["state"][i])
+            else:
+                self.optimizer.state.pop(param, None)
+
+        # `load_state_dict()` already copies into the existing parameters and buffers
+        if model is not None:
+            model.load_state_dict(state["model"])
 
     def _check_for_scheduler(self):
         for param_group in self.optimizer.param_groups:
@@ -270,7 +808,9 @@ class LRFinder(object):
                 shown . Default: None.
             suggest_lr (bool, optional): suggest a learning rate by
                 - 'steepest': the point with steepest gradient (minimal gradient)
-                you can use that point as a first guess for an LR. Default: True.
+                you can use that point as a first guess for an LR. The gradient is
+                taken w.r.t. the log of the learning rate, on the loss smoothed with a
+                Savitzky-Golay filter. Default: True.
 
         Returns:
             The matplotlib.axes.Axes object that contains the plot,
@@ -284,16 +824,14 @@ class LRFinder(object):
         if show_lr is not None and not isinstance(show_lr, float):
             raise ValueError("show_lr must be float")
 
-        # Get the data to plot from the history dictionary. Also, handle skip_end=0
-        # properly so the behaviour is the expected
-        lrs = self.history["lr"]
-        losses = self.history["loss"]
-        if skip_end == 0:
-            lrs = lrs[skip_start:]
-            losses = losses[skip_start:]
-        else:
-            lrs = lrs[skip_start:-skip_end]
-            losses = losses[skip_start:-skip_end]
+        # Get the data to plot from the history dictionary as arrays, so that slicing
+        # doesn't copy them. Also, handle skip_end=0 properly so the behaviour is the
+        # expected
+        lrs = np.asarray(self.history["lr"])
+        losses = np.asarray(self.history["loss"])
+        end = max(len(losses) - skip_end, 0)
+        lrs = lrs[skip_start:end]
+        losses = losses[skip_start:end]
 
         # Create the figure and axes object if axes was not already given
         fig = None
@@ -309,7 +847,17 @@ class LRFinder(object):
             print("LR suggestion: steepest gradient")
             min_grad_idx = None
             try:
-                min_grad_idx = (np.gradient(np.array(losses))).argmin()
+                # Take the slope of the loss w.r.t. the log of the learning rate with
+                # forward differences. When there are enough points, the loss is
+                # first smoothed with a Savitzky-Golay filter so that noise in the
+                # loss curve doesn't produce spurious minima
+                window_length = min(11, len(losses) // 5 * 2 + 1)
+                if window_length > 3:
+                    smoothed = _savgol_smooth(losses, window_length, polyorder=3)
+                else:
+                    smoothed = losses
+                slopes = np.diff(smoothed) / np.diff(np.log(lrs))
+                min_grad_idx = int(np.argmin(slopes))
             except ValueError:
                 print(
                     "Failed to compute the gradients, there might not be enough points."
@@ -339,12 +887,166 @@ class LRFinder(object):
         if fig is not None:
             plt.show()
 
-        if suggest_lr and min_grad_idx:
+        if suggest_lr and min_grad_idx is not None:
             return ax, lrs[min_grad_idx]
         else:
             return ax
 
 
+def _compile_step(step_fn):
+    compiled_fn = torch.compile(step_fn, mode="reduce-overhead", dynamic=False)
+
+    def step(*args, **kwargs):
+        # "reduce-overhead" uses CUDA graphs, whose outputs are overwritten by the
+        # next run, while the range test keeps the losses of several iterations
+        return _clone_tensors(compiled_fn(*args, **kwargs))
+
+    step._compiled_by_lr_finder = True
+    return step
+
+
+def _copy_into(target, source, keep=()):
+    """Updates the dict `target` to hold the values of `source`.
+
+    Tensors of `target` are updated in place when `source` holds a Tensor of the same
+    shape for their key; other values are replaced, Tensors by a clone.
+
+    Arguments:
+        target (dict): the dict to update.
+        source (dict): the values to copy.
+        keep (tuple, optional): keys of `target` that are left untouched. Default: ().
+    """
+    for key in list(target):
+        if key not in source and key not in keep:
+            del target[key]
+
+    for key, value in source.items():
+        if key in keep:
+            continue
+        current = target.get(key)
+        if (
+            isinstance(current, torch.Tensor)
+            and isinstance(value, torch.Tensor)
+            and current.shape == value.shape
+        ):
+            current.copy_(value)
+        elif isinstance(value, torch.Tensor):
+            target[key] = value.detach().clone()
+        else:
+            target[key] = value
+
+
+def _savgol_smooth(values, window_length, polyorder):
+    """Smooths a sequence with a Savitzky-Golay filter.
+
+    Gives the same result as `scipy.signal.savgol_filter(values, window_length,
+    polyorder)`: each point is replaced by the value of the polynomial fitted by least
+    squares to the `window_length` points around it, and the points closer than half
+    a window to the edges by the polynomial fitted to the first or last window.
+
+    Arguments:
+        values (numpy.ndarray): the sequence to smooth.
+        window_length (int): the length of the filter window, an odd number not
+            larger than `len(values)`.
+        polyorder (int): the order of the fitted polynomials, less than
+            `window_length`.
+
+    Returns:
+        A `numpy.ndarray` with the smoothed sequence.
+    """
+    half = window_length // 2
+    x = np.arange(window_length)
+
+    # The value at the centre of the window of the least-squares polynomial fit is a
+    # fixed linear combination of the points of the window
+    vander = np.vander(x - half, polyorder + 1, increasing=True)
+    coeffs = np.linalg.pinv(vander)[0]
+    smoothed = np.empty(len(values))
+    smoothed[half : len(values) - half] = np.correlate(values, coeffs, mode="valid")
+
+    if half > 0:
+        head = np.polyfit(x, values[:window_length], polyorder)
+        smoothed[:half] = np.polyval(head, x[:half])
+        tail = np.polyfit(x, values[-window_length:], polyorder)
+        smoothed[-half:] = np.polyval(tail, x[-half:])
+    return smoothed
+
+
+def _clone_tensors(obj):
+    # Clones the Tensors found in a (nested) tuple, list or dict
+    def clone(o):
+        if isinstance(o, torch.Tensor):
+            return o.detach().clone()
+        return o
+
+    return _tree_map(clone, obj)
+
+
+def _lr_schedule(start_lrs, end_lr, num_iter, step_mode):
+    """Computes the learning rates of a range test ahead of time.
+
+    Arguments:
+        start_lrs (list): the starting learning rate of each parameter group.
+        end_lr (float): the final learning rate.
+        num_iter (int): the number of iterations over which the test occurs.
+        step_mode (str): one of the available learning rate policies, linear or
+            exponential ("linear", "exp").
+
+    Returns:
+        A `numpy.ndarray` of shape (num_iter, len(start_lrs)) where row `i` holds the
+        learning rate of each parameter group at iteration `i`.
+    """
+    if num_iter <= 1:
+        raise ValueError("`num_iter` must be larger than 1")
+
+    if step_mode == "exp":
+        space = np.geomspace
+    elif step_mode == "linear":
+        space = np.linspace
+    else:
+        raise ValueError("expected one of (exp, linear), got {}".format(step_mode))
+
+    return np.stack([space(lr, end_lr, num_iter) for lr in start_lrs], axis=1)
+
+
+def _losses_to_numpy(losses):
+    # Copies all the losses to the host at once when they are Tensors
+    if isinstance(losses[0], torch.Tensor):
+        return torch.stack(losses).reshape(-1).cpu().double().numpy()
+    return np.asarray(losses, dtype=np.float64)
+
+
+def _smooth(losses, smooth_f, last_loss=None):
+    """Exponentially smooths a sequence of losses.
+
+    Arguments:
+        losses (numpy.ndarray): the raw losses.
+        smooth_f (float): the loss smoothing factor within the [0, 1[ interval.
+            Disabled if set to 0.
+        last_loss (float, optional): the smoothed loss that precedes `losses`. If
+            `None`, the first loss is left unchanged. Default: None.
+
+    Returns:
+        A `numpy.ndarray` with the smoothed losses.
+    """
+    if smooth_f == 0:
+        return losses
+    if last_loss is None:
+        last_loss = losses[0]
+
+    if lfilter is not None:
+        smoothed, _ = lfilter(
+            [smooth_f], [1, smooth_f - 1], losses, zi=[(1 - smooth_f) * last_loss]
+        )
+        return smoothed
+
+    smoothed = np.empty_like(losses)
+    for i, loss in enumerate(losses):
+        last_loss = smooth_f * loss + (1 - smooth_f) * last_loss
+        smoothed[i] = last_loss
+    return smoothed
+
+
 class LinearLR(_LRScheduler):
     """Linearly increases the learning rate between two boundaries over a number of
     iterations.